@@ -1,31 +1,201 @@
-import os, datetime as dt
-from typing import Dict, Any
+import os, time, queue, asyncio, logging, logging.handlers, datetime as dt
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import chain
+from typing import Dict, Any, NamedTuple
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlencode
 import httpx
+import orjson
+from celery import Celery, chord
+from celery.schedules import crontab
 from fastapi import FastAPI, Request, Header, BackgroundTasks
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse
 
 PIPEDRIVE_BASE = os.getenv("PIPEDRIVE_BASE", "https://api.pipedrive.com/v1")
 API_TOKEN = os.getenv("PIPEDRIVE_API_TOKEN")
-
-app = FastAPI()
-
-def pd_get(path: str, params: Dict[str, Any] = None):
-    params = params or {}
-    params["api_token"] = API_TOKEN
-    r = httpx.get(f"{PIPEDRIVE_BASE}{path}", params=params, timeout=30)
+# Uten REDIS_URL kjøres webhook-jobber som BackgroundTasks i web-prosessen
+REDIS_URL = os.getenv("REDIS_URL")
+
+# Logging via kø: selve skrivingen til stdout skjer i en egen tråd, ikke i event loopen
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+_log_queue_handler = logging.handlers.QueueHandler(queue.Queue(-1))
+_log_listener: logging.handlers.QueueListener | None = None
+
+def _start_log_listener():
+    # Lyttertråden overlever ikke fork (Celery prefork), så hver prosess får egen kø og tråd
+    global _log_listener
+    _log_queue_handler.queue = queue.Queue(-1)
+    _log_listener = logging.handlers.QueueListener(_log_queue_handler.queue, _log_handler)
+    _log_listener.start()
+
+_start_log_listener()
+os.register_at_fork(after_in_child=_start_log_listener)
+log = logging.getLogger("pipedrive")
+log.setLevel(logging.INFO)
+log.addHandler(_log_queue_handler)
+log.propagate = False
+
+app = FastAPI(default_response_class=ORJSONResponse)
+celery_app = Celery("pipedrive", broker=REDIS_URL, backend=REDIS_URL)
+celery_app.conf.timezone = "UTC"
+# Webhooken må svare raskt: uten Redis skal publisering feile på sekunder, ikke etter kombu-retries
+celery_app.conf.broker_connection_timeout = 2
+celery_app.conf.broker_transport_options = {"socket_connect_timeout": 2}
+celery_app.conf.beat_schedule = {
+    # 06:00 UTC = 08:00 Oslo (sommer)
+    "daily-sweep": {"task": "app.daily_sweep_task", "schedule": crontab(hour=6, minute=0)},
+}
+
+# Gjenbrukt klient: TCP/TLS-tilkoblinger deles mellom alle kall mot Pipedrive.
+# Med HTTP/2 multiplekses samtidige kall som strømmer over samme tilkobling,
+# så poolen holdes varm i stedet for å åpne nye tilkoblinger under sweep.
+_ACLIENT = httpx.AsyncClient(
+    base_url=PIPEDRIVE_BASE,
+    params={"api_token": API_TOKEN},
+    timeout=httpx.Timeout(30.0, connect=10.0),
+    limits=httpx.Limits(max_connections=32, max_keepalive_connections=32, keepalive_expiry=30.0),
+    http2=True,
+)
+
+# Pipedrive sin maks sidestørrelse, og hvor mange sider vi henter samtidig
+PAGE_LIMIT = 500
+PAGE_BATCH = 4
+
+# Maks samtidige deals i sweep – holder oss innenfor Pipedrive sin rate limit
+SWEEP_CONCURRENCY = 16
+
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Oppfølgings-e-post per stage
+_KK_SUBJECT = "Skal vi booke gratis befaring? – Softvask Norge"
+_KK_BODY = (
+    "Hei!\n\nVille bare følge opp om du fortsatt ønsker pris på tak/fasadevask. "
+    "Vi kan ta en gratis befaring når det passer.\n\n– Johan, Softvask Norge"
+)
+_TS_SUBJECT = "Spørsmål til tilbudet vårt? – Softvask Norge"
+_TS_BODY = (
+    "Hei!\n\nVille bare sjekke om du har sett på tilbudet. "
+    "Gi meg beskjed om du har spørsmål eller ønsker endringer.\n\n– Johan"
+)
+
+@app.on_event("shutdown")
+async def _close_clients():
+    await _ACLIENT.aclose()
+    _log_listener.stop()
+
+# Betinget GET for metadata som sjelden endres: ved 304 gjenbrukes forrige svar (rå bytes).
+# Bare /stages og enkeltpersoner (/persons/{id}) – listesidene fra /persons er for store
+# til å ligge i minnet i hver prosess.
+_CONDITIONAL_CACHE_SIZE = 4096
+_conditional_cache: "OrderedDict[str, tuple[Dict[str, str], bytes]]" = OrderedDict()
+
+def _is_conditional(path: str) -> bool:
+    return path == "/stages" or path.startswith("/persons/")
+
+def _request_key(path: str, params: Dict[str, Any] = None) -> str:
+    return f"{path}?{urlencode(sorted((params or {}).items()))}"
+
+# GET er idempotente: rate limit (429) og 503 prøves på nytt, etter Retry-After om den finnes
+_GET_RETRY_STATUSES = (429, 503)
+GET_ATTEMPTS = 4
+_MAX_RETRY_AFTER = 60.0
+
+def _retry_after(r: httpx.Response, attempt: int) -> float:
+    value = r.headers.get("Retry-After")
+    delay = 2.0 ** attempt
+    if value:
+        try:
+            delay = float(value)
+        except ValueError:
+            try:
+                delay = (parsedate_to_datetime(value) - dt.datetime.now(dt.timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                pass
+    return min(max(delay, 0.0), _MAX_RETRY_AFTER)
+
+async def _pd_get(path: str, params: Dict[str, Any] = None) -> bytes:
+    key = _request_key(path, params) if _is_conditional(path) else None
+    cached = _conditional_cache.get(key) if key else None
+    for attempt in range(GET_ATTEMPTS):
+        r = await _ACLIENT.get(path, params=params, headers=cached[0] if cached else None)
+        if r.status_code not in _GET_RETRY_STATUSES or attempt == GET_ATTEMPTS - 1:
+            break
+        await asyncio.sleep(_retry_after(r, attempt))
+    if r.status_code == 304 and cached:
+        _conditional_cache.move_to_end(key)
+        return cached[1]
     r.raise_for_status()
-    return r.json()
 
-def pd_post(path: str, data: Dict[str, Any]):
-    _params = {"api_token": API_TOKEN}
-    r = httpx.post(f"{PIPEDRIVE_BASE}{path}", params=_params, json=data, timeout=30)
+    if key:
+        validators = {}
+        if "ETag" in r.headers:
+            validators["If-None-Match"] = r.headers["ETag"]
+        if "Last-Modified" in r.headers:
+            validators["If-Modified-Since"] = r.headers["Last-Modified"]
+        if validators:
+            _conditional_cache[key] = (validators, r.content)
+            _conditional_cache.move_to_end(key)
+            if len(_conditional_cache) > _CONDITIONAL_CACHE_SIZE:
+                _conditional_cache.popitem(last=False)
+    return r.content
+
+# GET-er som allerede er i gang; identiske kall venter på samme svar i stedet for nytt kall.
+# Svaret deles som bytes og dekodes per kaller, så ingen deler (og muterer) samme objekt.
+_inflight: Dict[str, "asyncio.Task"] = {}
+
+async def pd_get(path: str, params: Dict[str, Any] = None):
+    key = _request_key(path, params)
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_pd_get(path, params))
+        _inflight[key] = task
+
+        def _done(t, key=key):
+            if _inflight.get(key) is t:
+                del _inflight[key]
+
+        task.add_done_callback(_done)
+    # shield: én avbrutt kaller skal ikke avbryte kallet for de andre
+    return orjson.loads(await asyncio.shield(task))
+
+async def pd_post(path: str, data: Dict[str, Any]):
+    r = await _ACLIENT.post(path, content=orjson.dumps(data), headers=_JSON_HEADERS)
     if r.status_code >= 400:
         # Viktig for feilsøk: se nøyaktig hva Pipedrive klager på
-        print(f"[PIPEDRIVE POST {path}] {r.status_code} {r.text}")
-        print(f"[PIPEDRIVE POST PAYLOAD] {data}")
+        log.error("[PIPEDRIVE POST %s] %s %s", path, r.status_code, r.text)
+        log.error("[PIPEDRIVE POST PAYLOAD] %s", data)
         r.raise_for_status()
-    return r.json()
-
-def add_note(
+    return orjson.loads(r.content)
+
+async def pd_get_all(path: str, params: Dict[str, Any] = None) -> list:
+    """Henter alle sider fra et liste-endepunkt.
+
+    Første side forteller om det finnes mer; resten hentes PAGE_BATCH sider
+    om gangen i parallell til vi treffer en side som ikke er full.
+    """
+    params = {**(params or {}), "limit": PAGE_LIMIT}
+    first = await pd_get(path, {**params, "start": 0})
+    items = list(first.get("data") or [])
+    pagination = (first.get("additional_data") or {}).get("pagination") or {}
+    more = pagination.get("more_items_in_collection", len(items) >= PAGE_LIMIT)
+    start = pagination.get("next_start") or PAGE_LIMIT
+
+    while more:
+        starts = [start + i * PAGE_LIMIT for i in range(PAGE_BATCH)]
+        pages = await asyncio.gather(*[pd_get(path, {**params, "start": s}) for s in starts])
+        for page in pages:
+            chunk = page.get("data") or []
+            items.extend(chunk)
+            if len(chunk) < PAGE_LIMIT:
+                more = False
+                break
+        start = starts[-1] + PAGE_LIMIT
+    return items
+
+def _note_payload(
     content: str,
     deal_id: Any = None,
     person_id: Any = None,
@@ -66,33 +236,116 @@ def add_note(
         # Dette var sannsynligvis grunnen til 400 hos deg
         raise RuntimeError("Note mangler link: deal_id/person_id/org_id/lead_id")
 
-    return pd_post("/notes", payload)
+    return payload
+
+async def add_note(
+    content: str,
+    deal_id: Any = None,
+    person_id: Any = None,
+    org_id: Any = None,
+    lead_id: Any = None,
+):
+    return await pd_post("/notes", _note_payload(content, deal_id, person_id, org_id, lead_id))
 
 
-def add_activity(deal_id: int, subject: str, due_in_days: int = 3, type_: str = "call"):
-    due = (dt.datetime.utcnow() + dt.timedelta(days=due_in_days)).strftime("%Y-%m-%d")
-    return pd_post("/activities", {
+async def add_activity(deal_id: int, subject: str, due_in_days: int = 3, type_: str = "call", now: dt.datetime | None = None):
+    if now is None:
+        now = dt.datetime.utcnow()
+    due = (now + dt.timedelta(days=due_in_days)).strftime("%Y-%m-%d")
+    return await pd_post("/activities", {
         "subject": subject, "type": type_, "deal_id": deal_id, "due_date": due
     })
 
 def send_followup_email(to_email: str, subject: str, body: str):
     # Foreløpig “dummy” – kobles til SendGrid/Mailgun senere.
-    print(f"[EMAIL] to={to_email} subj={subject}\n{body}\n")
+    log.info("[EMAIL] to=%s subj=%s\n%s\n", to_email, subject, body)
     return True
 
-def get_person_email(person_id: int) -> str | None:
+def _primary_email(person: dict) -> str | None:
+    # Pipedrive sender personer uten e-post som [{"value": "", ...}]
+    return (person.get("email")[0].get("value") or None) if person.get("email") else None
+
+# Stages endres sjelden – mappingen navn→id caches i prosessen
+STAGE_CACHE_TTL = 3600
+_stage_cache = {"expires": 0.0, "map": {}}
+
+async def get_stage_map() -> Dict[str, int]:
+    now = time.monotonic()
+    if now > _stage_cache["expires"]:
+        stages = (await pd_get("/stages")).get("data") or []
+        _stage_cache["map"] = {s["name"]: s["id"] for s in stages}
+        _stage_cache["expires"] = now + STAGE_CACHE_TTL
+    return _stage_cache["map"]
+
+async def get_person_email(person_id: int) -> str | None:
     if not person_id:
         return None
-    data = pd_get(f"/persons/{person_id}")
-    person = data.get("data") or {}
-    return person.get("email")[0]["value"] if person.get("email") else None
+    data = await pd_get(f"/persons/{person_id}")
+    return _primary_email(data.get("data") or {})
 
-def deal_last_activity_age_days(deal: dict) -> int:
-    lad = deal.get("last_activity_date")
+async def prefetch_person_emails() -> Dict[int, str | None]:
+    # Alle personer i bulk: én GET per PAGE_LIMIT personer i stedet for én per person
+    return {p["id"]: _primary_email(p) for p in await pd_get_all("/persons")}
+
+@lru_cache(maxsize=1024)
+def _parse_ymd(s: str) -> dt.date:
+    # Mange deals deler samme last_activity_date – hver dato parses bare én gang
+    return dt.date.fromisoformat(s)
+
+def last_activity_age_days(lad: str | None, today: dt.date | None = None) -> int:
     if not lad:
         return 999
-    d = dt.datetime.strptime(lad, "%Y-%m-%d")
-    return (dt.date.today() - d.date()).days
+    if today is None:
+        today = dt.date.today()
+    return (today - _parse_ymd(lad)).days
+
+# Markerer at /deals ikke hadde e-post inline, i motsetning til None = personen har ingen e-post
+_NOT_INLINED = object()
+
+class DealRow(NamedTuple):
+    # Sweep bruker bare disse feltene – små tupler i stedet for hele deal-dicten
+    id: int
+    stage_id: int | None
+    person_id: int | None
+    last_activity_date: str | None
+    # /deals har ofte personens e-post inline i person_id; da er den fasit og /persons trengs ikke
+    inline_email: Any
+
+def project_deal(d: dict) -> DealRow:
+    person = d.get("person_id") or {}
+    inline_email = _primary_email(person) if "email" in person else _NOT_INLINED
+    return DealRow(d["id"], d.get("stage_id"), person.get("value"), d.get("last_activity_date"), inline_email)
+
+_worker_loop: asyncio.AbstractEventLoop | None = None
+
+def _run_sync(coro):
+    # Celery-tasks er synkrone; én event loop per worker-prosess lar _ACLIENT gjenbruke poolen
+    global _worker_loop
+    if _worker_loop is None:
+        _worker_loop = asyncio.new_event_loop()
+    return _worker_loop.run_until_complete(coro)
+
+# Feil der Pipedrive ikke har lagret noe – trygt å prøve igjen uten å lage duplikater:
+# tilkoblingen kom aldri opp, eller Pipedrive avviste kallet (429 rate limit, 503 utilgjengelig).
+# Read-timeout og andre 5xx (502/504 o.l.) er ikke med: da kan skrivingen allerede være utført.
+_RETRY_SAFE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+_RETRY_SAFE_STATUSES = (429, 503)
+
+def _is_retryable(e: Exception) -> bool:
+    if isinstance(e, _RETRY_SAFE_ERRORS):
+        return True
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in _RETRY_SAFE_STATUSES
+    return False
+
+@celery_app.task(bind=True, acks_late=True, max_retries=5, ignore_result=True)
+def write_note_task(self, msg: str, deal_id: Any = None, person_id: Any = None, org_id: Any = None, lead_id: Any = None):
+    try:
+        return _run_sync(add_note(msg, deal_id=deal_id, person_id=person_id, org_id=org_id, lead_id=lead_id))
+    except httpx.HTTPError as e:
+        if not _is_retryable(e):
+            raise
+        raise self.retry(exc=e, countdown=2 ** self.request.retries)
 
 @app.get("/health")
 def health():
@@ -102,9 +355,9 @@ def health():
 @app.post("/webhook")
 async def webhook(request: Request, background_tasks: BackgroundTasks, x_pipedrive_signature: str | None = Header(default=None)):
     try:
-        payload = await request.json()
+        payload = orjson.loads(await request.body())
     except Exception as e:
-        print("[WEBHOOK] invalid json:", repr(e))
+        log.warning("[WEBHOOK] invalid json: %r", e)
         return {"ok": False, "error": "invalid json"}
 
     meta = payload.get("meta") or {}
@@ -120,12 +373,30 @@ async def webhook(request: Request, background_tasks: BackgroundTasks, x_pipedri
     stage_cur = current.get("stage_id")
     stage_prev = previous.get("stage_id")
 
-    print(f"[WEBHOOK] deal_id={deal_id} person_id={person_id} org_id={org_id} lead_id={lead_id} stage {stage_prev}->{stage_cur}")
+    log.info(
+        "[WEBHOOK] deal_id=%s person_id=%s org_id=%s lead_id=%s stage %s->%s",
+        deal_id, person_id, org_id, lead_id, stage_prev, stage_cur,
+    )
 
-    def _write_note_bg():
+    msg = f"Webhook: stage {stage_prev} → {stage_cur} @ {dt.datetime.utcnow().isoformat()}Z"
+
+    # Med Redis går notatet til Celery-worker (retries, egen concurrency); ellers i web-prosessen.
+    # Publisering er blokkerende I/O mot Redis, så den kjøres i threadpool.
+    if REDIS_URL:
+        try:
+            await run_in_threadpool(
+                write_note_task.apply_async,
+                args=(msg,),
+                kwargs={"deal_id": deal_id, "person_id": person_id, "org_id": org_id, "lead_id": lead_id},
+                retry=False,
+            )
+            return {"ok": True}
+        except Exception as e:
+            log.error("[WEBHOOK enqueue ERROR] %r – skriver notatet i web-prosessen", e)
+
+    async def _write_note_bg():
         try:
-            msg = f"Webhook: stage {stage_prev} → {stage_cur} @ {dt.datetime.utcnow().isoformat()}Z"
-            add_note(
+            await add_note(
                 msg,
                 deal_id=deal_id,
                 person_id=person_id,
@@ -133,59 +404,174 @@ async def webhook(request: Request, background_tasks: BackgroundTasks, x_pipedri
                 lead_id=lead_id,
             )
         except Exception as e:
-            print("[WEBHOOK add_note ERROR]", repr(e))
+            log.error("[WEBHOOK add_note ERROR] %r", e)
 
     background_tasks.add_task(_write_note_bg)
     return {"ok": True}
 
 
-# Daglig sweep (kalles av cron)
-@app.post("/daily-sweep")
-def daily_sweep():
-    stages = pd_get("/stages").get("data", [])
-    stage_name_to_id = {s["name"]: s["id"] for s in stages}
+def followup_needs(row: DealRow, stage_kunde_kontaktet, stage_tilbud_sendt, today: dt.date) -> tuple[bool, bool]:
+    sid = row.stage_id
+    if sid is None or sid not in (stage_kunde_kontaktet, stage_tilbud_sendt):
+        return False, False
+    age = last_activity_age_days(row.last_activity_date, today)
+    # “Kunde kontaktet” > 3 dager, “Tilbud sendt” > 7 dager
+    return sid == stage_kunde_kontaktet and age >= 3, sid == stage_tilbud_sendt and age >= 7
+
+# Pipedrive-skriv i sweep prøves på nytt bare ved feil der ingenting ble lagret
+SWEEP_WRITE_ATTEMPTS = 3
+
+async def _with_retry(make_call):
+    for attempt in range(SWEEP_WRITE_ATTEMPTS):
+        try:
+            return await make_call()
+        except httpx.HTTPError as e:
+            if attempt == SWEEP_WRITE_ATTEMPTS - 1 or not _is_retryable(e):
+                raise
+            await asyncio.sleep(2 ** attempt)
+
+async def send_followups(deal_id: int, email: str, needs_kk: bool, needs_ts: bool, processed: dict, now: dt.datetime):
+    if needs_kk:
+        sent = send_followup_email(email, _KK_SUBJECT, _KK_BODY)
+        if sent:
+            await asyncio.gather(
+                _with_retry(lambda: add_note("Auto-oppfølging sendt (Kunde kontaktet).", deal_id=deal_id)),
+                _with_retry(lambda: add_activity(deal_id, "Ring kunden hvis ingen svar", due_in_days=3, now=now)),
+            )
+            processed["kk_followups"] += 1
+
+    if needs_ts:
+        sent = send_followup_email(email, _TS_SUBJECT, _TS_BODY)
+        if sent:
+            await asyncio.gather(
+                _with_retry(lambda: add_note("Auto-oppfølging sendt (Tilbud sendt).", deal_id=deal_id)),
+                _with_retry(lambda: add_activity(deal_id, "Ring kunden hvis ingen svar", due_in_days=4, now=now)),
+            )
+            processed["ts_followups"] += 1
+
+class SweepCandidate(NamedTuple):
+    row: DealRow
+    needs_kk: bool
+    needs_ts: bool
+
+async def fetch_sweep_deals(today: dt.date) -> list[SweepCandidate]:
+    """Henter deals i de to oppfølgings-stagene og returnerer bare de som skal følges opp."""
+    stage_name_to_id = await get_stage_map()
     stage_kunde_kontaktet = stage_name_to_id.get("Kunde kontaktet")
     stage_tilbud_sendt = stage_name_to_id.get("Tilbud sendt")
 
-    deals = []
-    start = 0
-    while True:
-        chunk = pd_get("/deals", {"status": "open", "start": start, "limit": 500}).get("data") or []
-        deals += chunk
-        if len(chunk) < 500:
-            break
-        start += 500
+    # Pipedrive filtrerer på stage_id – henter bare de to aktuelle stagene, i parallell
+    target_stages = [sid for sid in (stage_kunde_kontaktet, stage_tilbud_sendt) if sid is not None]
+    per_stage = await asyncio.gather(*[
+        pd_get_all("/deals", {"status": "open", "stage_id": sid}) for sid in target_stages
+    ])
+    candidates = []
+    for d in chain.from_iterable(per_stage):
+        row = project_deal(d)
+        needs_kk, needs_ts = followup_needs(row, stage_kunde_kontaktet, stage_tilbud_sendt, today)
+        if needs_kk or needs_ts:
+            candidates.append(SweepCandidate(row, needs_kk, needs_ts))
+    return candidates
+
+async def resolve_emails(candidates: list[SweepCandidate]) -> list:
+    """Slår opp e-post for alle kandidater i én sweep.
+
+    Mange personer uten inline e-post: hent alle fra /persons i bulk. Ellers
+    enkeltoppslag, memoisert per person så flere deals deler én GET. Et feilet
+    oppslag gir None for den raden.
+    """
+    rows = [c.row for c in candidates]
+    person_ids = {row.person_id for row in rows if row.inline_email is _NOT_INLINED} - {None}
+    person_emails: Dict[int, str | None] = {}
+    # Færre personer enn én side: enkeltoppslag er billigere enn å hente hele /persons
+    if len(person_ids) > PAGE_LIMIT:
+        try:
+            person_emails = await prefetch_person_emails()
+        except Exception as e:
+            log.error("[SWEEP prefetch ERROR] %r – faller tilbake til enkeltoppslag", e)
+    email_cache: Dict[int, "asyncio.Future[str | None]"] = {}
+    sem = asyncio.Semaphore(SWEEP_CONCURRENCY)
+
+    async def _one(row: DealRow):
+        if row.inline_email is not _NOT_INLINED:
+            return row.inline_email
+        if row.person_id in person_emails:
+            return person_emails[row.person_id]
+        async with sem:
+            try:
+                # Cacher tasken, så samtidige deals for samme person deler én GET
+                if row.person_id not in email_cache:
+                    email_cache[row.person_id] = asyncio.ensure_future(get_person_email(row.person_id))
+                return await email_cache[row.person_id]
+            except Exception as e:
+                # Ett feilet oppslag (slettet person, 429 …) skal ikke stoppe sweepen for alle
+                log.error("[SWEEP deal %s email ERROR] %r", row.id, e)
+                return None
+
+    return await asyncio.gather(*[_one(row) for row in rows])
+
+# Daglig sweep – planlagt kjøring går via Celery Beat (daily_sweep_task), denne er for manuell kjøring
+@app.post("/daily-sweep")
+async def daily_sweep():
+    # Samme "nå" for hele sweepen i stedet for ett klokkeoppslag per deal
+    today = dt.date.today()
+    now = dt.datetime.utcnow()
+
+    candidates = await fetch_sweep_deals(today)
+    emails = await resolve_emails(candidates)
+    todo = [(c, email) for c, email in zip(candidates, emails) if email]
 
+    # Én event loop – vanlig dict holder, ingen lås nødvendig
     processed = {"kk_followups": 0, "ts_followups": 0}
-    for d in deals:
-        sid = d.get("stage_id")
-        person_id = d.get("person_id", {}).get("value")
-        email = get_person_email(person_id)
-
-        # “Kunde kontaktet” > 3 dager
-        if sid == stage_kunde_kontaktet and deal_last_activity_age_days(d) >= 3 and email:
-            sent = send_followup_email(
-                email,
-                "Skal vi booke gratis befaring? – Softvask Norge",
-                "Hei!\n\nVille bare følge opp om du fortsatt ønsker pris på tak/fasadevask. "
-                "Vi kan ta en gratis befaring når det passer.\n\n– Johan, Softvask Norge"
-            )
-            if sent:
-                add_note(d["id"], "Auto-oppfølging sendt (Kunde kontaktet).")
-                add_activity(d["id"], "Ring kunden hvis ingen svar", due_in_days=3)
-                processed["kk_followups"] += 1
-
-        # “Tilbud sendt” > 7 dager
-        if sid == stage_tilbud_sendt and deal_last_activity_age_days(d) >= 7 and email:
-            sent = send_followup_email(
-                email,
-                "Spørsmål til tilbudet vårt? – Softvask Norge",
-                "Hei!\n\nVille bare sjekke om du har sett på tilbudet. "
-                "Gi meg beskjed om du har spørsmål eller ønsker endringer.\n\n– Johan"
-            )
-            if sent:
-                add_note(d["id"], "Auto-oppfølging sendt (Tilbud sendt).")
-                add_activity(d["id"], "Ring kunden hvis ingen svar", due_in_days=4)
-                processed["ts_followups"] += 1
+    sem = asyncio.Semaphore(SWEEP_CONCURRENCY)
+
+    async def _send(c: SweepCandidate, email: str):
+        async with sem:
+            await send_followups(c.row.id, email, c.needs_kk, c.needs_ts, processed, now)
+
+    # Én feilet deal skal ikke stoppe rapporteringen – de andre kjører uansett ferdig
+    results = await asyncio.gather(*[_send(c, email) for c, email in todo], return_exceptions=True)
+    failed = 0
+    for (c, _), res in zip(todo, results):
+        if isinstance(res, Exception):
+            failed += 1
+            log.error("[SWEEP deal %s ERROR] %r", c.row.id, res)
+
+    return {"status": "ok", "processed": processed, "failed": failed}
+
 
-    return {"status": "ok", "processed": processed}
+@celery_app.task
+def process_deal_task(deal_id: int, email: str, needs_kk: bool, needs_ts: bool, now: str):
+    processed = {"kk_followups": 0, "ts_followups": 0}
+    try:
+        _run_sync(send_followups(deal_id, email, needs_kk, needs_ts, processed, dt.datetime.fromisoformat(now)))
+    except Exception as e:
+        # Én feilet deal skal ikke velte chord-en – summarize_sweep må alltid kjøre
+        log.error("[SWEEP deal %s ERROR] %r", deal_id, e)
+    return processed
+
+@celery_app.task
+def summarize_sweep(results: list):
+    processed = {"kk_followups": 0, "ts_followups": 0}
+    for r in results:
+        for k, v in r.items():
+            processed[k] += v
+    log.info("[SWEEP] %s", processed)
+    return processed
+
+@celery_app.task
+def daily_sweep_task():
+    # Hver deal som skal følges opp blir en subtask (med e-post ferdig slått opp);
+    # chord-en summerer tellerne når alle er ferdige
+    today = dt.date.today()
+    now = dt.datetime.utcnow().isoformat()
+    candidates = _run_sync(fetch_sweep_deals(today))
+    emails = _run_sync(resolve_emails(candidates))
+    header = [
+        process_deal_task.s(c.row.id, email, c.needs_kk, c.needs_ts, now)
+        for c, email in zip(candidates, emails)
+        if email
+    ]
+    if not header:
+        return summarize_sweep([])
+    chord(header)(summarize_sweep.s())